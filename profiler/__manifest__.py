@@ -3,7 +3,7 @@
     "author": "Vauxoo, Therp BV, Odoo Community Association (OCA)",
     "website": "https://github.com/OCA/server-tools",
     "category": "Tests",
-    "version": "14.0.1.0.0",
+    "version": "14.0.1.1.0",
     "license": "AGPL-3",
     "depends": ["web_tour"],
     "data": [
@@ -0,0 +1,16 @@
+from openupgradelib import openupgrade
+
+
+@openupgrade.migrate()
+def migrate(env, version):
+    # attachment_id used to be computed from the attachment's res_model/res_id
+    openupgrade.logged_query(
+        env.cr,
+        """
+            UPDATE profiler_profile_request_line prl
+            SET attachment_id = att.id
+            FROM ir_attachment att
+            WHERE att.res_model = 'profiler.profile.request.line'
+                AND att.res_id = prl.id;
+        """,
+    )
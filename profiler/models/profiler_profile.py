@@ -1,18 +1,19 @@
-import base64
 import logging
+import marshal
 import os
 import pstats
-import re
 import subprocess
 import sys
-import tempfile
+import threading
 from contextlib import contextmanager
 from cProfile import Profile
 from datetime import datetime
 from timeit import default_timer as timer
 
 import lxml.html
+from lxml import etree
 from psycopg2 import OperationalError, ProgrammingError
+from psycopg2.extras import execute_values
 
 from odoo import _, api, exceptions, fields, http, models, sql_db, tools
 
@@ -22,7 +23,9 @@ else:
     from io import BytesIO as IO
 
 DATETIME_FORMAT_FILE = "%Y%m%d_%H%M%S"
-CPROFILE_EMPTY_CHARS = b"{0"
+# Size of a cProfile dump of no stats: marshal writes an empty dict as
+# b"{0", or b"\xfb0" when it flags it as a reference
+CPROFILE_EMPTY_SIZE = 2
 PGOPTIONS = {
     "log_min_duration_statement": "0",
     "client_min_messages": "notice",
@@ -37,20 +40,14 @@ PGOPTIONS = {
 PGOPTIONS_ENV = " ".join(
     ["-c {}={}".format(param, value) for param, value in PGOPTIONS.items()]
 )
-PY_STATS_FIELDS = [
-    "ncalls",
-    "tottime",
-    "tt_percall",
-    "cumtime",
-    "ct_percall",
-    "file",
-    "lineno",
-    "method",
-]
-LINE_STATS_RE = re.compile(
-    r"(?P<%s>\d+/?\d+|\d+)\s+(?P<%s>\d+\.?\d+)\s+(?P<%s>\d+\.?\d+)\s+"
-    r"(?P<%s>\d+\.?\d+)\s+(?P<%s>\d+\.?\d+)\s+(?P<%s>.*):(?P<%s>\d+)"
-    r"\((?P<%s>.*)\)" % tuple(PY_STATS_FIELDS)
+PGBADGER_SECTION_IDS = (
+    "slowest-individual-queries",
+    "time-consuming-queries",
+    "most-frequent-queries",
+)
+# Compiled once and matching every section in a single tree walk
+PGBADGER_SECTIONS_XPATH = etree.XPath(
+    "//*[%s]" % " or ".join('@id="%s"' % sid for sid in PGBADGER_SECTION_IDS)
 )
 
 _logger = logging.getLogger(__name__)
@@ -68,24 +65,10 @@ class ProfilerProfileRequestLine(models.Model):
     user_id = fields.Many2one("res.users", string="User")
     user_context = fields.Char("Context")
     total_time = fields.Float("Time in ms")
-    attachment_id = fields.Reference(
-        selection=[("ir.attachment", "ir.attachment")],
-        compute="_compute_attachment_id",
-        string="pStats file",
+    attachment_id = fields.Many2one(
+        "ir.attachment", string="pStats file", readonly=True, ondelete="set null"
     )
 
-    def _compute_attachment_id(self):
-        attachments = self.env["ir.attachment"].search(
-            [("res_model", "=", self._name), ("res_id", "in", self.ids)]
-        )
-        attachments_by_id = {a.res_id: a.id for a in attachments}
-        for this in self:
-            attachment_id = attachments_by_id.get(this.id)
-            if not attachment_id:
-                this.attachment_id = None
-            else:
-                this.attachment_id = "ir.attachment,%d" % (attachment_id,)
-
     @api.depends("name", "create_date")
     def _compute_display_name(self):
         for httprequest in self:
@@ -103,31 +86,31 @@ class ProfilerProfileRequestLine(models.Model):
 
     @api.model
     def dump_stats(self, profile):
-        """This is called in 'request' mode only"""
+        """This is called in 'request' mode only.
+
+        Request profiles are small, so they are marshalled in memory exactly as
+        cProfile.Profile.dump_stats would write them, without a temporary file.
+        """
         cprofile_fname = self._get_attachment_name()
-        tf, cprofile_path = tempfile.mkstemp(suffix=".cprofile", prefix=cprofile_fname)
-        os.close(tf)
-        _logger.info("Dumping cProfile '%s'", cprofile_path)
-        profile.dump_stats(cprofile_path)
-        return cprofile_fname, cprofile_path
+        _logger.info("Dumping cProfile '%s'", cprofile_fname)
+        profile.create_stats()
+        if not profile.stats:
+            return cprofile_fname, None
+        return cprofile_fname, marshal.dumps(profile.stats)
 
-    def dump_stats_db(self, cprofile_fname, cprofile_path):
+    def dump_stats_db(self, cprofile_fname, cprofile_datas):
         """This is called in 'request' mode only"""
         self.ensure_one()
-        with open(cprofile_path, "rb") as f_cprofile:
-            datas = f_cprofile.read()
-
-        if not datas or datas == CPROFILE_EMPTY_CHARS:
+        if not cprofile_datas:
             _logger.info("cProfile stats empty.")
             return None
 
-        self.env["ir.attachment"].create(
+        self.attachment_id = self.env["ir.attachment"].create(
             {
                 "name": cprofile_fname,
                 "res_id": self.id,
                 "res_model": self._name,
-                "datas": base64.b64encode(datas),
-                "store_fname": cprofile_fname,
+                "raw": cprofile_datas,
                 "description": "cProfile dump stats",
             }
         )
@@ -243,12 +226,18 @@ class ProfilerProfile(models.Model):
     )
 
     def _compute_attachment_count(self):
+        groups = self.env["ir.attachment"].read_group(
+            [("res_model", "=", self._name), ("res_id", "in", self.ids)],
+            ["res_id"],
+            ["res_id"],
+        )
+        counts = {group["res_id"]: group["res_id_count"] for group in groups}
         for record in self:
-            self.attachment_count = self.env["ir.attachment"].search_count(
-                [("res_model", "=", self._name), ("res_id", "=", record.id)]
-            )
+            record.attachment_count = counts.get(record.id, 0)
 
     def unlink(self):
+        if ProfilerProfile.profile_owner_id in self.ids:
+            self._stop_full_profile()
         self.env["ir.attachment"].search(
             [("res_model", "=", self._name), ("res_id", "in", self.ids)]
         ).unlink()
@@ -324,6 +313,10 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
 
     profile = Profile()
     enabled = None
+    # Id of the 'full' mode profile that enabled the shared profile
+    profile_owner_id = None
+    # Per thread Profile reused across HTTP requests in 'request' mode
+    request_profiles = threading.local()
     pglogs_enabled = None
 
     # True to activate it False to inactivate None to do nothing
@@ -332,14 +325,16 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
     # Params dict with values before to change it.
     psql_params_original = {}
 
+    # Path to the pgbadger binary, only looked up until it is found
+    _pgbadger_bin_cache = None
+
     @api.model
     def now_utc(self):
-        self.env.cr.execute("SHOW log_timezone")
-        zone = self.env.cr.fetchone()[0]
+        # log_timezone can change on a configuration reload, read it in the
+        # same query instead of caching it
         self.env.cr.execute(
             "SELECT to_char(current_timestamp AT TIME "
-            "ZONE %s, 'YYYY-MM-DD HH24:MI:SS')",
-            (zone,),
+            "ZONE current_setting('log_timezone'), 'YYYY-MM-DD HH24:MI:SS')"
         )
         now = self.env.cr.fetchall()[0][0]
         return now
@@ -357,8 +352,21 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
                     "the parameter '--workers=0'"
                 )
             )
+        if (
+            self.enable_python
+            and self.python_method == "full"
+            and self._full_profile_owner_active()
+        ):
+            raise exceptions.UserError(
+                _("Another profile is already profiling all activity.")
+            )
         _logger.info("Enabling profiler")
         if self.enable_python and self.python_method == "full":
+            # Take over from a stale owner, if any, and start from an empty
+            # profile instead of reusing the stats table of previous runs
+            ProfilerProfile.profile.disable()
+            ProfilerProfile.profile = Profile()
+            ProfilerProfile.profile_owner_id = self.id
             ProfilerProfile.enabled = True
             self.write(dict(date_started=self.now_utc(), state="enabled"))
             self._reset_postgresql()
@@ -383,12 +391,13 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
         self._reset_connection(self.state == "enabled")
 
     def _reset_connection(self, enable):
-        for connection in sql_db._Pool._connections:
-            with connection[0].cursor() as pool_cr:
-                params = PGOPTIONS if enable else ProfilerProfile.psql_params_original
-                for param, value in params.items():
+        params = PGOPTIONS if enable else ProfilerProfile.psql_params_original
+        set_sql = self._get_set_params_sql(params)
+        if set_sql:
+            for connection in sql_db._Pool._connections:
+                with connection[0].cursor() as pool_cr:
                     try:
-                        pool_cr.execute("SET {} TO {}".format(param, value))
+                        pool_cr.execute(set_sql)
                     except (OperationalError, ProgrammingError) as oe:
                         pool_cr.connection.rollback()
                         raise exceptions.UserError(
@@ -399,17 +408,87 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
                             )
                             % str(oe)
                         )
-            ProfilerProfile.activate_deactivate_pglogs = enable
+        ProfilerProfile.activate_deactivate_pglogs = enable
+
+    @staticmethod
+    def _get_set_params_sql(params):
+        """Return one statement setting all the given parameters at once, so
+        each pooled connection is reset in a single round trip"""
+        return "; ".join(
+            "SET {} TO {}".format(param, value) for param, value in params.items()
+        )
 
-    def get_stats_string(self, cprofile_path):
+    def get_stats_string(self, pstats_obj):
+        """Render the human-readable report of an already loaded pstats.Stats"""
         pstats_stream = IO()
-        pstats_obj = pstats.Stats(cprofile_path, stream=pstats_stream)
+        pstats_obj.stream = pstats_stream
         pstats_obj.sort_stats("cumulative")
         pstats_obj.print_stats()
-        pstats_stream.seek(0)
-        stats_string = pstats_stream.read()
-        pstats_stream = None
-        return stats_string
+        return pstats_stream.getvalue()
+
+    def _store_python_lines(self, pstats_obj):
+        """Replace the profiler.profile.python.line records of this profile
+        with the raw pstats data, using one DELETE and multi-row INSERTs.
+
+        Built-in functions get a line too, named as pstats prints them.
+
+        The ORM is bypassed because a full profile easily has thousands of
+        lines and Model.create() inserts them one by one.
+        """
+        self.ensure_one()
+        line_obj = self.env["profiler.profile.python.line"]
+        line_obj.flush()
+        cr = self.env.cr
+        cr.execute(
+            "DELETE FROM profiler_profile_python_line WHERE profile_id = %s "
+            "RETURNING id",
+            (self.id,),
+        )
+        # Same cleanup as ProfilerProfilePythonLine.unlink()
+        deleted_ids = [row[0] for row in cr.fetchall()]
+        if deleted_ids:
+            self.env["ir.attachment"].search(
+                [("res_model", "=", line_obj._name), ("res_id", "in", deleted_ids)]
+            ).unlink()
+        profile_id, uid, now = self.id, self.env.uid, fields.Datetime.now()
+        rows = []
+        for func, (cc, nc, tt, ct, _callers) in pstats_obj.stats.items():
+            fname, lineno, method = func
+            if fname == "~":
+                # Built-ins, which pstats prints as '{built-in method ...}'
+                cprof_fname = pstats.func_std_string(func)
+            else:
+                cprof_fname = "{}:{} ({})".format(fname, lineno, method)
+            rows.append(
+                (
+                    profile_id,
+                    tt,
+                    cc,
+                    nc,
+                    tt / nc if nc else 0.0,
+                    ct,
+                    ct / cc if cc else 0.0,
+                    cprof_fname,
+                    uid,
+                    now,
+                    uid,
+                    now,
+                )
+            )
+        execute_values(
+            cr,
+            """
+            INSERT INTO profiler_profile_python_line (
+                profile_id, cprof_tottime, cprof_ncalls, cprof_nrcalls,
+                cprof_ttpercall, cprof_cumtime, cprof_ctpercall, cprof_fname,
+                create_uid, create_date, write_uid, write_date
+            ) VALUES %s
+            """,
+            rows,
+            page_size=1000,
+        )
+        line_obj.invalidate_cache()
+        self.invalidate_cache(["py_stats_lines"], self.ids)
 
     def dump_postgresql_logs(self, indexed=None):
         self.ensure_one()
@@ -419,8 +498,7 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
             return
         pgbadger_cmd_str = subprocess.list2cmdline(pgbadger_cmd)
         self.description += ("\nRunning the command: %s") % pgbadger_cmd_str
-        result = tools.exec_command_pipe(*pgbadger_cmd)
-        datas = result[1].read()
+        datas = subprocess.run(pgbadger_cmd, stdout=subprocess.PIPE, check=False).stdout
         if not datas:
             self.description += "\nPgbadger output is empty!"
             return
@@ -430,46 +508,39 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
                 "name": fname,
                 "res_id": self.id,
                 "res_model": self._name,
-                "datas": base64.b64encode(datas),
-                "store_fname": fname,
+                "raw": datas,
                 "description": "pgbadger html output",
             }
         )
-        xpaths = [
-            '//*[@id="slowest-individual-queries"]',
-            '//*[@id="time-consuming-queries"]',
-            '//*[@id="most-frequent-queries"]',
-        ]
         # pylint: disable=unbalanced-tuple-unpacking
         (
             self.pg_stats_slowest_html,
             self.pg_stats_time_consuming_html,
             self.pg_stats_most_frequent_html,
-        ) = self._compute_pgbadger_html(datas, xpaths)
+        ) = self._compute_pgbadger_html(datas)
 
     @staticmethod
-    def _compute_pgbadger_html(html_doc, xpaths):
+    def _compute_pgbadger_html(html_doc):
         html = lxml.html.document_fromstring(html_doc)
-        result = []
-        for this_xpath in xpaths:
-            this_result = html.xpath(this_xpath)
-            result.append(tools.html_sanitize(lxml.html.tostring(this_result[0])))
-        return result
+        sections = {}
+        for node in PGBADGER_SECTIONS_XPATH(html):
+            sections.setdefault(node.get("id"), node)
+        return [
+            tools.html_sanitize(lxml.html.tostring(sections[section_id]))
+            for section_id in PGBADGER_SECTION_IDS
+        ]
 
     def _get_pgbadger_command(self):
         self.ensure_one()
         # TODO: Catch early the following errors.
-        try:
-            pgbadger_bin = tools.find_in_path("pgbadger")
-        except OSError:
-            self.description += "\nInstall 'apt-get install pgbadger'"
-            return
-        try:
-            if not self.pg_log_path:
-                raise OSError
-            with open(self.pg_log_path):
-                pass
-        except OSError:
+        if not ProfilerProfile._pgbadger_bin_cache:
+            try:
+                ProfilerProfile._pgbadger_bin_cache = tools.find_in_path("pgbadger")
+            except OSError:
+                self.description += "\nInstall 'apt-get install pgbadger'"
+                return
+        pgbadger_bin = ProfilerProfile._pgbadger_bin_cache
+        if not self.pg_log_path or not os.access(self.pg_log_path, os.R_OK):
             self.description += (
                 "\nCheck if exists and has permission to read the log file."
                 "\nMaybe running: chmod 604 '%s'"
@@ -518,57 +589,25 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
             _logger.info("Dumping cProfile '%s'", cprofile_path)
             ProfilerProfile.profile.dump_stats(cprofile_path)
 
-            with open(cprofile_path, "rb") as f_cprofile:
-                datas = f_cprofile.read()
-            if datas and datas != CPROFILE_EMPTY_CHARS:
-                attachment = self.env["ir.attachment"].create(
-                    {
-                        "name": cprofile_fname,
-                        "res_id": self.id,
-                        "res_model": self._name,
-                        "datas": base64.b64encode(datas),
-                        "store_fname": cprofile_fname,
-                        "description": "cProfile dump stats",
-                    }
-                )
+            if os.path.getsize(cprofile_path) > CPROFILE_EMPTY_SIZE:
+                with open(cprofile_path, "rb") as f_cprofile:
+                    attachment = self.env["ir.attachment"].create(
+                        {
+                            "name": cprofile_fname,
+                            "res_id": self.id,
+                            "res_model": self._name,
+                            "raw": f_cprofile.read(),
+                            "description": "cProfile dump stats",
+                        }
+                    )
                 _logger.info("A datas was saved, here %s", attachment.name)
                 try:
                     if self.use_py_index:
-                        py_stats = self.get_stats_string(ProfilerProfile.profile)
-                        self.env["profiler.profile.python.line"].search(
-                            [("profile_id", "=", self.id)]
-                        ).unlink()
-                        for py_stat_line in py_stats.splitlines():
-                            py_stat_line = py_stat_line.strip("\r\n ")
-                            py_stat_line_match = (
-                                LINE_STATS_RE.match(py_stat_line)
-                                if py_stat_line
-                                else None
-                            )
-                            if not py_stat_line_match:
-                                continue
-                            data = {
-                                field: py_stat_line_match.group(field)
-                                for field in PY_STATS_FIELDS
-                            }
-                            data["rcalls"], data["calls"] = (
-                                "%(ncalls)s/%(ncalls)s" % data
-                            ).split("/")[:2]
-                            self.env["profiler.profile.python.line"].create(
-                                {
-                                    "cprof_tottime": data["tottime"],
-                                    "cprof_ncalls": data["calls"],
-                                    "cprof_nrcalls": data["rcalls"],
-                                    "cprof_ttpercall": data["tt_percall"],
-                                    "cprof_cumtime": data["cumtime"],
-                                    "cprof_ctpercall": data["ct_percall"],
-                                    "cprof_fname": (
-                                        "%(file)s:%(lineno)s (%(method)s)" % data
-                                    ),
-                                    "profile_id": self.id,
-                                }
-                            )
-                        attachment.index_content = py_stats
+                        # Snapshot the profiler once for both the lines and
+                        # the report
+                        pstats_obj = pstats.Stats(ProfilerProfile.profile)
+                        self._store_python_lines(pstats_obj)
+                        attachment.index_content = self.get_stats_string(pstats_obj)
                 except OSError:
                     # Fancy feature but not stop process if fails
                     _logger.info(
@@ -588,21 +627,45 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
         _logger.info("Clear profiler")
         if reset_date:
             self.date_started = self.now_utc()
-        ProfilerProfile.profile.clear()
+        if self._owns_full_profile():
+            ProfilerProfile.profile.clear()
         return True
 
+    def _owns_full_profile(self):
+        """Whether this profile enabled the shared 'full' mode profile, only
+        that one may stop or clear it"""
+        self.ensure_one()
+        return ProfilerProfile.profile_owner_id == self.id
+
+    def _full_profile_owner_active(self):
+        """Whether the shared 'full' mode profile is running for a profile
+        that still exists and is enabled"""
+        owner_id = ProfilerProfile.profile_owner_id
+        if not ProfilerProfile.enabled or not owner_id:
+            return False
+        owner = self.browse(owner_id).exists()
+        return owner.state == "enabled"
+
+    def _stop_full_profile(self):
+        ProfilerProfile.enabled = False
+        ProfilerProfile.profile.disable()
+        ProfilerProfile.profile_owner_id = None
+
     def disable(self):
         self.ensure_one()
         _logger.info("Disabling profiler")
-        if self.enable_python and self.python_method == "full":
+        owns_full_profile = self._owns_full_profile()
+        if owns_full_profile:
             ProfilerProfile.enabled = False
         elif self.enable_python and self.python_method == "request":
             http.request.httprequest.session.oca_profiler = False
         self.state = "disabled"
         self.date_finished = self.now_utc()
-        if self.enable_python and self.python_method == "full":
+        if owns_full_profile:
             self.dump_stats()
         self.clear(reset_date=False)
+        if owns_full_profile:
+            ProfilerProfile.profile_owner_id = None
         self._reset_postgresql()
         return True
 
@@ -612,40 +675,45 @@ export PGOPTIONS="-c log_min_duration_statement=0 \\
         # Thread local profile management, according to the shared "enabled"
         if ProfilerProfile.enabled:
             _logger.debug("Catching profiling")
-            ProfilerProfile.profile.enable()
+            # enable() may swap the shared profile while this call runs, stop
+            # the same one that was started
+            profile = ProfilerProfile.profile
+            profile.enable()
             try:
                 yield
             finally:
-                if ProfilerProfile.enabled:
-                    ProfilerProfile.profile.disable()
+                profile.disable()
+            return
 
         # Per-session profile management, according to a flag saved on session
-        elif (
-            http.request
-            and http.request.httprequest
-            and http.request.httprequest.session
-            and getattr(http.request.httprequest.session, "oca_profiler", False)
-        ):
-            profile = Profile()
+        request = http.request
+        session = request and request.httprequest and request.httprequest.session
+        oca_profiler_id = session and getattr(session, "oca_profiler", False)
+        if oca_profiler_id:
+            # Take the thread's pooled profile out of the pool while in use, so
+            # nested calls in the same thread get their own one
+            profile = getattr(ProfilerProfile.request_profiles, "profile", None)
+            ProfilerProfile.request_profiles.profile = None
+            if profile is None:
+                profile = Profile()
+            start = timer()
             profile.enable()
             try:
-                oca_profiler_id = http.request.httprequest.session.oca_profiler
-                RequestLine = http.request.env["profiler.profile.request.line"]
-                profiler = http.request.env["profiler.profile"].browse(oca_profiler_id)
-                profile = Profile()
-                start = timer()
-                profile.enable()
                 yield
             finally:
                 end = timer()
                 profile.disable()
             try:
-                cprofile_fname, cprofile_path = RequestLine.dump_stats(profile)
+                RequestLine = request.env["profiler.profile.request.line"]
+                profiler = request.env["profiler.profile"].browse(oca_profiler_id)
+                cprofile_fname, cprofile_datas = RequestLine.dump_stats(profile)
                 request_line = profiler.sudo().create_request_line()
-                request_line.dump_stats_db(cprofile_fname, cprofile_path)
+                request_line.dump_stats_db(cprofile_fname, cprofile_datas)
                 request_line.total_time = (end - start) * 1000.0
             except:  # noqa
                 pass
+            profile.clear()
+            ProfilerProfile.request_profiles.profile = profile
 
         else:
             yield
@@ -1,11 +1,21 @@
 # Copyright 2018 Vauxoo (https://www.vauxoo.com) <info@vauxoo.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import pstats
+from cProfile import Profile
 from unittest.mock import MagicMock, patch
 
 import odoo.http
+from odoo.exceptions import UserError
 from odoo.tests.common import HttpCase, get_db_name, tagged
 
+from ..models.profiler_profile import ProfilerProfile
+
+
+def _recurse(depth):
+    if depth:
+        _recurse(depth - 1)
+
 
 @tagged("-at_install", "post_install")
 class TestProfiling(HttpCase):
@@ -43,6 +53,94 @@ class TestProfiling(HttpCase):
             )
         )
         profile.disable()
+        self.assertTrue(profile.py_stats_lines)
+
+    def test_store_python_lines(self):
+        """Python lines hold primitive calls in cprof_ncalls and total calls,
+        recursive ones included, in cprof_nrcalls"""
+        profile = self.env["profiler.profile"].create({"name": "this_profiler"})
+        cprofile = Profile()
+        cprofile.enable()
+        _recurse(4)
+        cprofile.disable()
+        profile._store_python_lines(pstats.Stats(cprofile))
+        line = profile.py_stats_lines.filtered(
+            lambda py_line: py_line.cprof_fname.endswith("(_recurse)")
+        )
+        self.assertEqual(len(line), 1)
+        self.assertEqual(line.cprof_ncalls, 1)
+        self.assertEqual(line.cprof_nrcalls, 5)
+        # Storing again replaces the previous lines
+        profile._store_python_lines(pstats.Stats(cprofile))
+        self.assertNotIn(line, profile.py_stats_lines)
+
+    def test_profile_full_single_owner(self):
+        """Only one profile can profile all activity, and other profiles
+        can't clear its stats"""
+        prof_obj = self.env["profiler.profile"]
+        profile = prof_obj.create(
+            {"name": "this_profiler", "enable_python": True, "python_method": "full"}
+        )
+        other_full = prof_obj.create(
+            {"name": "other_profiler", "enable_python": True, "python_method": "full"}
+        )
+        other_request = prof_obj.create(
+            {
+                "name": "other_http_profiler",
+                "enable_python": True,
+                "python_method": "request",
+            }
+        )
+        profile.enable()
+        self.addCleanup(profile.disable)
+        with self.assertRaisesRegex(UserError, "already profiling all activity"):
+            other_full.enable()
+        self.assertFalse(
+            self.xmlrpc_common.authenticate(
+                self.env.cr.dbname, "this is not a user", "this is not a password", {}
+            )
+        )
+        other_full.clear()
+        other_request.clear()
+        self.assertTrue(ProfilerProfile.profile.getstats())
+
+    def test_profile_full_owner_unlink(self):
+        """Deleting the profile profiling all activity stops it"""
+        prof_obj = self.env["profiler.profile"]
+        profile = prof_obj.create(
+            {"name": "this_profiler", "enable_python": True, "python_method": "full"}
+        )
+        other_full = prof_obj.create(
+            {"name": "other_profiler", "enable_python": True, "python_method": "full"}
+        )
+        profile.enable()
+        self.addCleanup(prof_obj._stop_full_profile)
+        profile.unlink()
+        self.assertFalse(ProfilerProfile.enabled)
+        self.assertFalse(ProfilerProfile.profile_owner_id)
+        other_full.enable()
+        self.addCleanup(other_full.disable)
+        self.assertEqual(ProfilerProfile.profile_owner_id, other_full.id)
+
+    def test_attachment_count(self):
+        """Each profile counts its own attachments when computed together"""
+        prof_obj = self.env["profiler.profile"]
+        profiles = prof_obj.create(
+            [{"name": "this_profiler"}, {"name": "other_profiler"}]
+        )
+        self.env["ir.attachment"].create(
+            [
+                {
+                    "name": "attachment_%d" % i,
+                    "res_model": profiles._name,
+                    "res_id": profiles[0].id,
+                    "raw": b"data",
+                }
+                for i in range(2)
+            ]
+        )
+        profiles.invalidate_cache(["attachment_count"])
+        self.assertEqual(profiles.mapped("attachment_count"), [2, 0])
 
     def test_onchange(self):
         prof_obj = self.env["profiler.profile"]